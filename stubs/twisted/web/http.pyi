@@ -56,6 +56,8 @@ class Request:
     def getClientAddress(self) -> IAddress: ...
     def requestReceived(self, command: bytes, path: bytes, version: bytes) -> None: ...
 
+class PotentialDataLoss(Exception): ...
+
 class HTTPClient(LineReceiver):
     def sendCommand(self, command: bytes, path: bytes) -> None: ...
     def sendHeader(self, name: bytes, value: bytes) -> None: ...
@@ -101,7 +101,7 @@ class ApnsPushkin(ConcurrencyLimitedPushkin):
     MAX_FIELD_LENGTH = 1024
     MAX_JSON_BODY_SIZE = 4096
 
-    UNDERSTOOD_CONFIG_FIELDS = {
+    UNDERSTOOD_CONFIG_FIELDS = ConcurrencyLimitedPushkin.UNDERSTOOD_CONFIG_FIELDS | {
         "type",
         "platform",
         "certfile",
@@ -111,7 +111,7 @@ class ApnsPushkin(ConcurrencyLimitedPushkin):
         "topic",
         "push_type",
         "convert_device_token_to_hex",
-    } | ConcurrencyLimitedPushkin.UNDERSTOOD_CONFIG_FIELDS
+    }
 
     APNS_PUSH_TYPES = {
         "alert": PushType.ALERT,
@@ -125,8 +125,8 @@ class ApnsPushkin(ConcurrencyLimitedPushkin):
     def __init__(self, name: str, sygnal: "Sygnal", config: Dict[str, Any]) -> None:
         super().__init__(name, sygnal, config)
 
-        nonunderstood = set(self.cfg.keys()).difference(self.UNDERSTOOD_CONFIG_FIELDS)
-        if len(nonunderstood) > 0:
+        nonunderstood = self.cfg.keys() - self.UNDERSTOOD_CONFIG_FIELDS
+        if nonunderstood:
             logger.warning(
                 "The following configuration fields are not understood: %s",
                 nonunderstood,
@@ -15,12 +15,10 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import asyncio
-import json
 import logging
 import os
 import time
 from enum import Enum
-from io import BytesIO
 from typing import TYPE_CHECKING, Any, AnyStr, Dict, List, Optional, Tuple
 
 # We are using an unstable async google-auth API, but it's there since 3+ years
@@ -32,7 +30,7 @@ from google.oauth2._credentials_async import Credentials
 from opentracing import Span, logs, tags
 from prometheus_client import Counter, Gauge, Histogram
 from twisted.internet.defer import Deferred, DeferredSemaphore
-from twisted.web.client import FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.web.client import readBody
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IResponse
 
@@ -50,7 +48,13 @@ from sygnal.notifications import (
     Notification,
     NotificationContext,
 )
-from sygnal.utils import NotificationLoggerAdapter, json_decoder, twisted_sleep
+from sygnal.utils import (
+    BytesBodyProducer,
+    NotificationLoggerAdapter,
+    json_decoder,
+    json_encoder,
+    twisted_sleep,
+)
 
 if TYPE_CHECKING:
     from sygnal.sygnal import Sygnal
@@ -124,7 +128,7 @@ class GcmPushkin(ConcurrencyLimitedPushkin):
     Pushkin that relays notifications to Google/Firebase Cloud Messaging.
     """
 
-    UNDERSTOOD_CONFIG_FIELDS = {
+    UNDERSTOOD_CONFIG_FIELDS = ConcurrencyLimitedPushkin.UNDERSTOOD_CONFIG_FIELDS | {
         "type",
         "api_key",
         "api_version",
@@ -132,25 +136,25 @@ class GcmPushkin(ConcurrencyLimitedPushkin):
         "max_connections",
         "project_id",
         "service_account_file",
-    } | ConcurrencyLimitedPushkin.UNDERSTOOD_CONFIG_FIELDS
+    }
 
     def __init__(self, name: str, sygnal: "Sygnal", config: Dict[str, Any]) -> None:
         super().__init__(name, sygnal, config)
 
-        nonunderstood = set(self.cfg.keys()).difference(self.UNDERSTOOD_CONFIG_FIELDS)
-        if len(nonunderstood) > 0:
+        nonunderstood = self.cfg.keys() - self.UNDERSTOOD_CONFIG_FIELDS
+        if nonunderstood:
             logger.warning(
                 "The following configuration fields are not understood: %s",
                 nonunderstood,
             )
 
-        self.http_pool = HTTPConnectionPool(reactor=sygnal.reactor)
         self.max_connections = self.get_config(
             "max_connections", int, DEFAULT_MAX_CONNECTIONS
         )
 
         self.connection_semaphore = DeferredSemaphore(self.max_connections)
-        self.http_pool.maxPersistentPerHost = self.max_connections
+        sygnal.reserve_http_pool_connections(self.max_connections)
+        self.http_pool = sygnal.http_pool
 
         tls_client_options_factory = ClientTLSOptionsFactory()
 
@@ -263,7 +267,7 @@ class GcmPushkin(ConcurrencyLimitedPushkin):
         Returns:
 
         """
-        body_producer = FileBodyProducer(BytesIO(json.dumps(body).encode()))
+        body_producer = BytesBodyProducer(json_encoder.encode(body).encode())
 
         # we use the semaphore to actually limit the number of concurrent
         # requests, since the HTTPConnectionPool will actually just lead to more
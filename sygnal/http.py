@@ -14,12 +14,11 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import json
 import logging
 import sys
 import time
-import traceback
-from typing import TYPE_CHECKING, Any, Callable, List, Union
+from io import BytesIO
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Union
 from uuid import uuid4
 
 from opentracing import Format, Span, logs, tags
@@ -39,8 +38,8 @@ from sygnal.exceptions import (
     InvalidNotificationException,
     NotificationDispatchException,
 )
-from sygnal.notifications import Notification, NotificationContext, Pushkin
-from sygnal.utils import NotificationLoggerAdapter, json_decoder
+from sygnal.notifications import Notification, NotificationContext, Pushkin, is_glob
+from sygnal.utils import NotificationLoggerAdapter, json_decoder, json_encoder
 
 if TYPE_CHECKING:
     from sygnal.sygnal import Sygnal
@@ -79,11 +78,104 @@ REQUESTS_IN_FLIGHT_GUAGE = Gauge(
     labelnames=["resource"],
 )
 
+# The status codes that the notify handler responds with in the normal course
+# of things. The metric children for these are looked up once, up front.
+NOTIFY_RESPONSE_CODES = (200, 400, 500, 502)
+
+# Error messages given in response to bad requests, along with their encoded
+# forms so that they don't need encoding on every response.
+EXPECTED_JSON_MSG = "Expected JSON request body"
+EXPECTED_JSON_MSG_BYTES = EXPECTED_JSON_MSG.encode()
+INVALID_NOTIFICATION_MSG = (
+    "Invalid notification: expecting object in 'notification' key"
+)
+INVALID_NOTIFICATION_MSG_BYTES = INVALID_NOTIFICATION_MSG.encode()
+NO_DEVICES_MSG = "No devices in notification"
+NO_DEVICES_MSG_BYTES = NO_DEVICES_MSG.encode()
+
+
+class _AppIdTrieNode:
+    def __init__(self) -> None:
+        self.children: Dict[str, "_AppIdTrieNode"] = {}
+        self.pushkins: List[Pushkin] = []
+
+
+class AppIdPushkinIndex:
+    """
+    A trie of pushkins, keyed on the dot-separated segments of their app ID
+    patterns.
+
+    Each pushkin is stored at the node for the literal (wildcard-free) segments
+    at the start of its pattern, so that looking up an app ID only has to test
+    the patterns of pushkins along the path for that app ID, rather than every
+    configured pushkin.
+
+    The results of recent lookups are also cached, since the same app IDs tend
+    to come up again and again.
+    """
+
+    # The maximum number of app IDs to cache the matching pushkins of. App IDs
+    # come from the homeserver, so this has to be bounded.
+    MAX_CACHED_APPIDS = 4096
+
+    def __init__(self, pushkins: Dict[str, Pushkin]):
+        self._cache: Dict[str, List[Pushkin]] = {}
+        self._root = _AppIdTrieNode()
+        for name, pushkin in pushkins.items():
+            node = self._root
+            for segment in name.split("."):
+                if is_glob(segment):
+                    break
+                node = node.children.setdefault(segment, _AppIdTrieNode())
+            node.pushkins.append(pushkin)
+
+    def find(self, appid: str) -> List[Pushkin]:
+        """
+        Finds all pushkins whose app ID pattern matches the given app ID.
+
+        The returned list must not be modified.
+        """
+        pushkins = self._cache.get(appid)
+        if pushkins is None:
+            pushkins = self._find_uncached(appid)
+            if len(self._cache) >= self.MAX_CACHED_APPIDS:
+                # evict the oldest entry
+                del self._cache[next(iter(self._cache))]
+            self._cache[appid] = pushkins
+        return pushkins
+
+    def _find_uncached(self, appid: str) -> List[Pushkin]:
+        candidates = list(self._root.pushkins)
+        node = self._root
+        for segment in appid.split("."):
+            child = node.children.get(segment)
+            if child is None:
+                break
+            node = child
+            candidates.extend(node.pushkins)
+
+        return [pushkin for pushkin in candidates if pushkin.handles_appid(appid)]
+
 
 class V1NotifyHandler(Resource):
     def __init__(self, sygnal: "Sygnal"):
         super().__init__()
         self.sygnal = sygnal
+        self.pushkin_index = AppIdPushkinIndex(sygnal.pushkins)
+
+        self._responses_counters = {
+            code: PUSHGATEWAY_HTTP_RESPONSES_COUNTER.labels(code=code)
+            for code in NOTIFY_RESPONSE_CODES
+        }
+        self._handle_histograms = {
+            code: NOTIFY_HANDLE_HISTOGRAM.labels(code=code)
+            for code in NOTIFY_RESPONSE_CODES
+        }
+        # Note this also ensures the per-pushkin counter appears in metrics
+        # even if it hasn't yet been incremented.
+        self._pushes_by_pushkin_counters = {
+            name: NOTIFS_BY_PUSHKIN.labels(name) for name in sygnal.pushkins
+        }
 
     isLeaf = True
 
@@ -98,9 +190,39 @@ class V1NotifyHandler(Resource):
     def render_POST(self, request: Request) -> Union[int, bytes]:
         response = self._handle_request(request)
         if response != NOT_DONE_YET:
-            PUSHGATEWAY_HTTP_RESPONSES_COUNTER.labels(code=request.code).inc()
+            self._count_response(request.code)
         return response
 
+    def _count_response(self, code: int) -> None:
+        """Increments the HTTP responses counter for the given status code."""
+        counter = self._responses_counters.get(code)
+        if counter is None:
+            counter = PUSHGATEWAY_HTTP_RESPONSES_COUNTER.labels(code=code)
+        counter.inc()
+
+    def _count_pushes(self, devices: int, pushes_by_pushkin: Dict[str, int]) -> None:
+        """
+        Increments the push counters for the devices of a notification.
+
+        Args:
+            devices: The number of devices we were asked to push to.
+            pushes_by_pushkin: The number of devices dispatched to each pushkin,
+                by pushkin name.
+        """
+        NOTIFS_RECEIVED_DEVICE_PUSH_COUNTER.inc(devices)
+        for pushkin_name, pushes in pushes_by_pushkin.items():
+            counter = self._pushes_by_pushkin_counters.get(pushkin_name)
+            if counter is None:
+                counter = NOTIFS_BY_PUSHKIN.labels(pushkin_name)
+            counter.inc(pushes)
+
+    def _observe_handle_time(self, code: int, req_time: float) -> None:
+        """Records the time taken to handle a request with the given status code."""
+        histogram = self._handle_histograms.get(code)
+        if histogram is None:
+            histogram = NOTIFY_HANDLE_HISTOGRAM.labels(code=code)
+        histogram.observe(req_time)
+
     def _handle_request(self, request: Request) -> Union[int, bytes]:
         """
         Actually handle the request.
@@ -140,18 +262,18 @@ class V1NotifyHandler(Resource):
             try:
                 body = json_decoder.decode(request.content.read().decode("utf-8"))
             except Exception as exc:
-                msg = "Expected JSON request body"
-                log.warning(msg, exc_info=exc)
+                log.warning(EXPECTED_JSON_MSG, exc_info=exc)
                 root_span.log_kv({logs.EVENT: "error", "error.object": exc})
                 request.setResponseCode(400)
-                return msg.encode()
+                return EXPECTED_JSON_MSG_BYTES
 
             if "notification" not in body or not isinstance(body["notification"], dict):
-                msg = "Invalid notification: expecting object in 'notification' key"
-                log.warning(msg)
-                root_span.log_kv({logs.EVENT: "error", "message": msg})
+                log.warning(INVALID_NOTIFICATION_MSG)
+                root_span.log_kv(
+                    {logs.EVENT: "error", "message": INVALID_NOTIFICATION_MSG}
+                )
                 request.setResponseCode(400)
-                return msg.encode()
+                return INVALID_NOTIFICATION_MSG_BYTES
 
             try:
                 notif = Notification(body["notification"])
@@ -170,10 +292,9 @@ class V1NotifyHandler(Resource):
             NOTIFS_RECEIVED_COUNTER.inc()
 
             if len(notif.devices) == 0:
-                msg = "No devices in notification"
-                log.warning(msg)
+                log.warning(NO_DEVICES_MSG)
                 request.setResponseCode(400)
-                return msg.encode()
+                return NO_DEVICES_MSG_BYTES
 
             root_span_accounted_for = True
 
@@ -191,15 +312,14 @@ class V1NotifyHandler(Resource):
         except Exception as exc_val:
             root_span.set_tag(tags.ERROR, True)
 
-            # [2] corresponds to the traceback
-            trace = traceback.format_tb(sys.exc_info()[2])
             root_span.log_kv(
                 {
                     logs.EVENT: tags.ERROR,
                     logs.MESSAGE: str(exc_val),
                     logs.ERROR_OBJECT: exc_val,
                     logs.ERROR_KIND: type(exc_val),
-                    logs.STACK: trace,
+                    # [2] corresponds to the traceback
+                    logs.STACK: sys.exc_info()[2],
                 }
             )
             raise
@@ -223,11 +343,7 @@ class V1NotifyHandler(Resource):
             return [self.sygnal.pushkins[appid]]
 
         # otherwise, find any pushkins whose appid patterns match
-        return [
-            pushkin
-            for pushkin in self.sygnal.pushkins.values()
-            if pushkin.handles_appid(appid)
-        ]
+        return self.pushkin_index.find(appid)
 
     async def _handle_dispatch(
         self,
@@ -247,11 +363,17 @@ class V1NotifyHandler(Resource):
         notif: the notification to dispatch
         context: the context of the notification
         """
+        # the number of devices we have been asked to push to, and how many of
+        # them were dispatched to each pushkin, which are added to the metrics
+        # in one go once we are done, rather than once per device.
+        devices_received = 0
+        pushes_by_pushkin: Dict[str, int] = {}
+
         try:
             rejected = []
 
             for d in notif.devices:
-                NOTIFS_RECEIVED_DEVICE_PUSH_COUNTER.inc()
+                devices_received += 1
 
                 appid = d.app_id
                 found_pushkins = self.find_pushkins(appid)
@@ -270,7 +392,9 @@ class V1NotifyHandler(Resource):
                     "Sending push to pushkin %s for app ID %s", pushkin.name, appid
                 )
 
-                NOTIFS_BY_PUSHKIN.labels(pushkin.name).inc()
+                pushes_by_pushkin[pushkin.name] = (
+                    pushes_by_pushkin.get(pushkin.name, 0) + 1
+                )
 
                 result = await pushkin.dispatch_notification(notif, d, context)
                 if not isinstance(result, list):
@@ -278,7 +402,7 @@ class V1NotifyHandler(Resource):
 
                 rejected += result
 
-            request.write(json.dumps({"rejected": rejected}).encode())
+            request.write(json_encoder.encode({"rejected": rejected}).encode())
 
             if rejected:
                 log.info(
@@ -295,13 +419,18 @@ class V1NotifyHandler(Resource):
             if not request._disconnected:
                 request.finish()
 
-            PUSHGATEWAY_HTTP_RESPONSES_COUNTER.labels(code=request.code).inc()
+            try:
+                self._count_pushes(devices_received, pushes_by_pushkin)
+            except Exception:
+                log.error("Failed to count pushes.", exc_info=True)
+
+            self._count_response(request.code)
             root_span.set_tag(tags.HTTP_STATUS_CODE, request.code)
 
             req_time = time.perf_counter() - context.start_time
             if req_time > 0:
                 # can be negative as perf_counter() may not be monotonic
-                NOTIFY_HANDLE_HISTOGRAM.labels(code=request.code).observe(req_time)
+                self._observe_handle_time(request.code, req_time)
             if not 200 <= request.code < 300:
                 root_span.set_tag(tags.ERROR, True)
             root_span.finish()
@@ -320,6 +449,23 @@ class SizeLimitingRequest(server.Request):
     # Arbitrarily limited to 512 KiB.
     MAX_REQUEST_SIZE = 512 * 1024
 
+    def gotLength(self, length: Optional[int]) -> None:
+        # If the client has told us up front that the body is too large, drop the
+        # connection straight away rather than buffering it until we hit the limit.
+        # Chunked requests have no length, and are limited in handleContentChunk.
+        if length is not None and length > self.MAX_REQUEST_SIZE:
+            logger.info(
+                "Aborting connection from %s because the request exceeds maximum size",
+                self.client,
+            )
+            assert self.transport is not None
+            self.transport.abortConnection()
+
+        # Since request bodies are limited to MAX_REQUEST_SIZE, always buffer them
+        # in memory rather than letting Twisted spool larger ones to a temporary
+        # file.
+        self.content = BytesIO()
+
     def handleContentChunk(self, data: bytes) -> None:
         # we should have a content by now
         assert self.content, "handleContentChunk() called before gotLength()"
@@ -15,7 +15,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import abc
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Type, TypeVar, overload
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+    Pattern,
+    Type,
+    TypeVar,
+    overload,
+)
 
 from matrix_common.regex import glob_to_regex
 from opentracing import Span
@@ -32,6 +42,9 @@ if TYPE_CHECKING:
 
 T = TypeVar("T")
 
+# sentinel for distinguishing a missing key from one which is set to None
+_MISSING = object()
+
 
 @overload
 def get_key(raw: Dict[str, Any], key: str, type_: Type[T], default: T) -> T: ...
@@ -46,18 +59,30 @@ def get_key(
 def get_key(
     raw: Dict[str, Any], key: str, type_: Type[T], default: Optional[T] = None
 ) -> Optional[T]:
-    if key not in raw:
+    value = raw.get(key, _MISSING)
+    if value is _MISSING:
         return default
-    if not isinstance(raw[key], type_):
+    if not isinstance(value, type_):
         raise InvalidNotificationException(f"{key} is of invalid type")
-    return raw[key]
+    return value
+
+
+def is_glob(pattern: str) -> bool:
+    """Checks whether the given app ID pattern contains any glob wildcards."""
+    return "*" in pattern or "?" in pattern
 
 
 class Tweaks:
+    __slots__ = ("sound",)
+
     def __init__(self, raw: Dict[str, Any]):
         self.sound: Optional[str] = get_key(raw, "sound", str)
 
 
+# Shared by all devices without tweaks, so must never be modified.
+_EMPTY_TWEAKS = Tweaks({})
+
+
 class Device:
     def __init__(self, raw: Dict[str, Any]):
         if "app_id" not in raw or not isinstance(raw["app_id"], str):
@@ -73,15 +98,22 @@ class Device:
 
         self.pushkey_ts: int = get_key(raw, "pushkey_ts", int, 0)
         self.data: Optional[Dict[str, Any]] = get_key(raw, "data", dict)
-        self.tweaks = Tweaks(get_key(raw, "tweaks", dict, {}))
+        tweaks = get_key(raw, "tweaks", dict)
+        self.tweaks = Tweaks(tweaks) if tweaks else _EMPTY_TWEAKS
 
 
 class Counts:
+    __slots__ = ("unread", "missed_calls")
+
     def __init__(self, raw: Dict[str, Any]):
         self.unread: Optional[int] = get_key(raw, "unread", int)
         self.missed_calls: Optional[int] = get_key(raw, "missed_calls", int)
 
 
+# Shared by all notifications without counts, so must never be modified.
+_EMPTY_COUNTS = Counts({})
+
+
 class Notification:
     def __init__(self, notif: dict):
         # optional attributes
@@ -97,21 +129,24 @@ class Notification:
         self.type: Optional[str] = notif.get("type")
         self.sender: Optional[str] = notif.get("sender")
 
-        if "devices" not in notif or not isinstance(notif["devices"], list):
+        devices = notif.get("devices")
+        if not isinstance(devices, list):
             raise InvalidNotificationException("Expected list in 'devices' key")
 
-        if "counts" in notif:
-            self.counts = Counts(notif["counts"])
-        else:
-            self.counts = Counts({})
+        counts = get_key(notif, "counts", dict)
+        self.counts = Counts(counts) if counts else _EMPTY_COUNTS
 
-        self.devices = [Device(d) for d in notif["devices"]]
+        self.devices = [Device(d) for d in devices]
 
 
 class Pushkin(abc.ABC):
     def __init__(self, name: str, sygnal: "Sygnal", config: Dict[str, Any]):
         self.name = name
-        self.appid_pattern = glob_to_regex(name, ignore_case=False)
+        # a name without wildcards can only ever match an identical app ID, so
+        # don't bother with a regex for it.
+        self.appid_pattern: Optional[Pattern[str]] = None
+        if is_glob(name):
+            self.appid_pattern = glob_to_regex(name, ignore_case=False)
         self.cfg = config
         self.sygnal = sygnal
 
@@ -126,18 +161,24 @@ class Pushkin(abc.ABC):
     def get_config(
         self, key: str, type_: Type[T], default: Optional[T] = None
     ) -> Optional[T]:
-        if key not in self.cfg:
+        value = self.cfg.get(key, _MISSING)
+        if value is _MISSING:
             return default
-        if not isinstance(self.cfg[key], type_):
+        if not isinstance(value, type_):
             raise PushkinSetupException(
                 f"{key} is of incorrect type, please check that the entry for {key} is "
                 f"formatted correctly in the config file. "
             )
-        return self.cfg[key]
+        return value
 
     def handles_appid(self, appid: str) -> bool:
         """Checks whether the pushkin is responsible for the given app ID"""
-        return self.name == appid or self.appid_pattern.match(appid) is not None
+        if self.name == appid:
+            return True
+        return (
+            self.appid_pattern is not None
+            and self.appid_pattern.match(appid) is not None
+        )
 
     @abc.abstractmethod
     async def dispatch_notification(
@@ -177,7 +218,7 @@ class ConcurrencyLimitedPushkin(Pushkin):
     # We start turning away requests after this limit is reached.
     DEFAULT_CONCURRENCY_LIMIT = 512
 
-    UNDERSTOOD_CONFIG_FIELDS = {"inflight_request_limit"}
+    UNDERSTOOD_CONFIG_FIELDS = frozenset({"inflight_request_limit"})
 
     RATELIMITING_DROPPED_REQUESTS = Counter(
         "sygnal_inflight_request_limit_drop",
@@ -224,6 +265,8 @@ class ConcurrencyLimitedPushkin(Pushkin):
 
 
 class NotificationContext(object):
+    __slots__ = ("request_id", "opentracing_span", "start_time")
+
     def __init__(self, request_id: str, opentracing_span: Span, start_time: float):
         """
         Args:
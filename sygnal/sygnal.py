@@ -14,19 +14,18 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import copy
 import importlib
 import logging
 import logging.config
+import logging.handlers
 import os
 import sys
-from typing import Any, Dict, Generator, Set, cast
+from typing import Any, Dict, FrozenSet, Generator, List, Optional, Type, cast
 
 import opentracing
 import prometheus_client
 import yaml
 from opentracing import Tracer
-from opentracing.scope_managers.asyncio import AsyncioScopeManager
 from twisted.internet import asyncioreactor, defer
 from twisted.internet.defer import Deferred, ensureDeferred
 from twisted.internet.interfaces import (
@@ -38,11 +37,19 @@ from twisted.internet.interfaces import (
 )
 from twisted.python import log as twisted_log
 from twisted.python.failure import Failure
+from twisted.web.client import HTTPConnectionPool
 from zope.interface import Interface
 
 from sygnal.http import PushGatewayApiServer
 from sygnal.notifications import Pushkin
 
+try:
+    # use libyaml's parser, which is much faster than the pure-Python one, if
+    # PyYAML was built with it.
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore[assignment]
+
 logger = logging.getLogger(__name__)
 
 CONFIG_DEFAULTS: Dict[str, Any] = {
@@ -62,6 +69,53 @@ CONFIG_DEFAULTS: Dict[str, Any] = {
     "apps": {},
 }
 
+# The configuration sections and fields within them which Sygnal understands.
+# Anything else in the configuration is warned about by check_config.
+UNDERSTOOD_CONFIG_SECTIONS = frozenset(CONFIG_DEFAULTS.keys())
+HTTP_CONFIG_FIELDS = frozenset({"port", "bind_addresses"})
+LOG_CONFIG_FIELDS = frozenset({"setup", "access"})
+ACCESS_LOG_CONFIG_FIELDS = frozenset({"file", "enabled", "x_forwarded_for"})
+METRICS_CONFIG_FIELDS = frozenset({"opentracing", "sentry", "prometheus"})
+OPENTRACING_CONFIG_FIELDS = frozenset(
+    {"enabled", "implementation", "jaeger", "service_name"}
+)
+PROMETHEUS_CONFIG_FIELDS = frozenset({"enabled", "address", "port"})
+SENTRY_CONFIG_FIELDS = frozenset({"enabled", "dsn"})
+
+# The pushkin classes which have been loaded so far, by pushkin type.
+_pushkin_classes: Dict[str, Type[Pushkin]] = {}
+
+
+def get_pushkin_class(app_type: str) -> Type[Pushkin]:
+    """
+    Find the class implementing a type of pushkin, importing its module if it
+    hasn't been already.
+    Args:
+        app_type: The pushkin type, as given in the configuration. This is
+            either the name of a built-in type, or the fully-qualified name of
+            a pushkin class.
+
+    Returns:
+        The pushkin class.
+    """
+    clarse = _pushkin_classes.get(app_type)
+    if clarse is not None:
+        return clarse
+
+    if "." in app_type:
+        kind_split = app_type.rsplit(".", 1)
+        to_import = kind_split[0]
+        to_construct = kind_split[1]
+    else:
+        to_import = f"sygnal.{app_type}pushkin"
+        to_construct = f"{app_type.capitalize()}Pushkin"
+
+    logger.info("Importing pushkin module: %s", to_import)
+    pushkin_module = importlib.import_module(to_import)
+    clarse = getattr(pushkin_module, to_construct)
+    _pushkin_classes[app_type] = clarse
+    return clarse
+
 
 class SygnalReactor(
     IReactorFDSet,
@@ -93,8 +147,24 @@ class Sygnal:
         self.pushkins: Dict[str, Pushkin] = {}
         self.tracer = tracer
 
+        # Connection pool shared by the pushkins which make HTTP requests, so
+        # that several apps using the same push service (e.g. FCM) share their
+        # connections to it. See reserve_http_pool_connections.
+        self.http_pool = HTTPConnectionPool(reactor=custom_reactor)
+        self.http_pool.maxPersistentPerHost = 0
+
+        self.log_queue_listeners: List[logging.handlers.QueueListener] = []
         logging_dict_config = config["log"]["setup"]
-        logging.config.dictConfig(logging_dict_config)
+        if logging_dict_config:
+            logging.config.dictConfig(logging_dict_config)
+            self.log_queue_listeners = start_log_queue_listeners()
+
+        if self.log_queue_listeners:
+            # stop them once the reactor has stopped, so that everything logged
+            # during shutdown is still handled
+            self.reactor.addSystemEventTrigger(
+                "after", "shutdown", stop_log_queue_listeners, self.log_queue_listeners
+            )
 
         logger.debug("Started logging")
 
@@ -146,6 +216,7 @@ class Sygnal:
             if tracecfg["implementation"] == "jaeger":
                 try:
                     import jaeger_client
+                    from opentracing.scope_managers.asyncio import AsyncioScopeManager
 
                     jaeger_cfg = jaeger_client.Config(
                         config=tracecfg["jaeger"],
@@ -169,6 +240,18 @@ class Sygnal:
                     "Unknown OpenTracing implementation: %s.", tracecfg["impl"]
                 )
 
+    def reserve_http_pool_connections(self, max_connections: int) -> None:
+        """
+        Make the shared HTTP connection pool keep enough connections open for a
+        pushkin which will use it.
+
+        Args:
+            max_connections: The maximum number of concurrent requests the
+                pushkin will make. The pool keeps this many more connections
+                open per host.
+        """
+        self.http_pool.maxPersistentPerHost += max_connections
+
     async def _make_pushkin(self, app_name: str, app_config: Dict[str, Any]) -> Pushkin:
         """
         Load and instantiate a pushkin.
@@ -179,30 +262,53 @@ class Sygnal:
         Returns:
             A pushkin of the desired type.
         """
-        app_type = app_config["type"]
-        if "." in app_type:
-            kind_split = app_type.rsplit(".", 1)
-            to_import = kind_split[0]
-            to_construct = kind_split[1]
-        else:
-            to_import = f"sygnal.{app_type}pushkin"
-            to_construct = f"{app_type.capitalize()}Pushkin"
-
-        logger.info("Importing pushkin module: %s", to_import)
-        pushkin_module = importlib.import_module(to_import)
-        logger.info("Creating pushkin: %s", to_construct)
-        clarse = getattr(pushkin_module, to_construct)
+        clarse = get_pushkin_class(app_config["type"])
+        logger.info("Creating pushkin: %s", clarse.__name__)
         return await clarse.create(app_name, self, app_config)
 
     async def make_pushkins_then_start(self) -> None:
-        for app_id, app_cfg in self.config["apps"].items():
+        apps = self.config["apps"]
+
+        # Resolve every pushkin class up front, so that a misconfigured app type
+        # fails startup before any pushkin starts its (possibly slow) setup.
+        for app_cfg in apps.values():
             try:
-                self.pushkins[app_id] = await self._make_pushkin(app_id, app_cfg)
+                get_pushkin_class(app_cfg["type"])
             except Exception:
+                logger.error("Failed to load pushkin for kind '%s'", app_cfg["type"])
+                raise
+
+        # Create the pushkins concurrently, as creating one may involve network
+        # requests (e.g. fetching credentials) that we don't want to serialise.
+        results = await defer.DeferredList(
+            [
+                ensureDeferred(self._make_pushkin(app_id, app_cfg))
+                for app_id, app_cfg in apps.items()
+            ],
+            consumeErrors=True,
+        )
+
+        failure: Optional[Failure] = None
+        for (app_id, app_cfg), (success, result) in zip(apps.items(), results):
+            if success:
+                self.pushkins[app_id] = result
+            else:
+                # on failure, DeferredList gives the Failure as the result
+                app_failure = cast(Failure, result)
                 logger.error(
-                    "Failed to load and create pushkin for kind '%s'" % app_cfg["type"]
+                    "Failed to load and create pushkin for kind '%s' (app ID %s)",
+                    app_cfg["type"],
+                    app_id,
+                    exc_info=(  # type: ignore[arg-type]
+                        app_failure.type,
+                        app_failure.value,
+                        app_failure.getTracebackObject(),
+                    ),
                 )
-                raise
+                failure = failure or app_failure
+
+        if failure is not None:
+            failure.raiseException()
 
         if len(self.pushkins) == 0:
             raise RuntimeError(
@@ -240,6 +346,48 @@ class Sygnal:
         self.reactor.run()
 
 
+def start_log_queue_listeners() -> List[logging.handlers.QueueListener]:
+    """
+    Start the listeners of the QueueHandlers in the logging configuration.
+
+    Since Python 3.12, dictConfig can create a QueueHandler along with a
+    QueueListener which passes its records on to other handlers, but it does not
+    start the listener, so the records would never be handled.
+
+    Returns:
+        The listeners which were started.
+    """
+    loggers = [logging.getLogger()]
+    loggers.extend(
+        log
+        for log in logging.Logger.manager.loggerDict.values()
+        if isinstance(log, logging.Logger)
+    )
+
+    listeners: List[logging.handlers.QueueListener] = []
+    for log in loggers:
+        for handler in log.handlers:
+            listener = getattr(handler, "listener", None)
+            if (
+                isinstance(handler, logging.handlers.QueueHandler)
+                and isinstance(listener, logging.handlers.QueueListener)
+                and listener not in listeners
+            ):
+                listener.start()
+                listeners.append(listener)
+    return listeners
+
+
+def stop_log_queue_listeners(
+    listeners: List[logging.handlers.QueueListener],
+) -> None:
+    """
+    Stop the given QueueListeners, once they have handled all the queued records.
+    """
+    for listener in listeners:
+        listener.stop()
+
+
 def parse_config() -> Dict[str, Any]:
     """
     Find and load Sygnal's configuration file.
@@ -249,8 +397,8 @@ def parse_config() -> Dict[str, Any]:
     config_path = os.getenv("SYGNAL_CONF", "sygnal.yaml")
     print("Using configuration file: %s" % config_path, file=sys.stderr)
     try:
-        with open(config_path) as file_handle:
-            return yaml.safe_load(file_handle)
+        with open(config_path, "rb") as file_handle:
+            return yaml.load(file_handle, Loader=SafeLoader)
     except FileNotFoundError:
         logger.critical(
             "Could not find configuration file!\n" "Path: %s\n" "Absolute Path: %s",
@@ -266,40 +414,47 @@ def check_config(config: Dict[str, Any]) -> None:
     Args:
         config: The loaded configuration.
     """
-    UNDERSTOOD_CONFIG_FIELDS = CONFIG_DEFAULTS.keys()
 
     def check_section(
-        section_name: str, known_keys: Set[str], cfgpart: Dict[str, Any] = config
+        section_name: str, known_keys: FrozenSet[str], cfgpart: Dict[str, Any] = config
     ) -> None:
-        nonunderstood = set(cfgpart[section_name].keys()).difference(known_keys)
-        if len(nonunderstood) > 0:
+        nonunderstood = cfgpart[section_name].keys() - known_keys
+        if nonunderstood:
             logger.warning(
                 f"The following configuration fields in '{section_name}' "
                 f"are not understood: %s",
                 nonunderstood,
             )
 
-    nonunderstood = set(config.keys()).difference(UNDERSTOOD_CONFIG_FIELDS)
-    if len(nonunderstood) > 0:
+    nonunderstood = config.keys() - UNDERSTOOD_CONFIG_SECTIONS
+    if nonunderstood:
         logger.warning(
             "The following configuration sections are not understood: %s", nonunderstood
         )
 
-    check_section("http", {"port", "bind_addresses"})
-    check_section("log", {"setup", "access"})
-    check_section(
-        "access", {"file", "enabled", "x_forwarded_for"}, cfgpart=config["log"]
-    )
-    check_section("metrics", {"opentracing", "sentry", "prometheus"})
-    check_section(
-        "opentracing",
-        {"enabled", "implementation", "jaeger", "service_name"},
-        cfgpart=config["metrics"],
-    )
-    check_section(
-        "prometheus", {"enabled", "address", "port"}, cfgpart=config["metrics"]
-    )
-    check_section("sentry", {"enabled", "dsn"}, cfgpart=config["metrics"])
+    check_section("http", HTTP_CONFIG_FIELDS)
+    check_section("log", LOG_CONFIG_FIELDS)
+    check_section("access", ACCESS_LOG_CONFIG_FIELDS, cfgpart=config["log"])
+    check_section("metrics", METRICS_CONFIG_FIELDS)
+    check_section("opentracing", OPENTRACING_CONFIG_FIELDS, cfgpart=config["metrics"])
+    check_section("prometheus", PROMETHEUS_CONFIG_FIELDS, cfgpart=config["metrics"])
+    check_section("sentry", SENTRY_CONFIG_FIELDS, cfgpart=config["metrics"])
+
+
+def _copy_config_value(value: Any) -> Any:
+    """
+    Copy a configuration value, such that modifying the copy does not modify
+    the original.
+
+    This is much cheaper than copy.deepcopy, because it only needs to handle
+    the containers that can appear in a configuration: values that are not
+    dicts or lists are immutable and are shared.
+    """
+    if isinstance(value, dict):
+        return {k: _copy_config_value(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy_config_value(v) for v in value]
+    return value
 
 
 def merge_left_with_defaults(
@@ -313,26 +468,33 @@ def merge_left_with_defaults(
 
     Returns:
         A merged configuration, with loaded_config preferred over defaults.
+        Values taken from the defaults are copied, so the merged configuration
+        can be modified without affecting the defaults.
     """
-    result = defaults.copy()
-
-    if loaded_config is None:
-        return result
-
-    # copy defaults or override them
-    for k, v in result.items():
-        if isinstance(v, dict):
-            if k in loaded_config:
-                result[k] = merge_left_with_defaults(v, loaded_config[k])
+    result: Dict[str, Any] = {}
+
+    # (merged section, section defaults, loaded section) for each section which
+    # remains to be merged
+    to_merge = [(result, defaults, loaded_config)]
+
+    while to_merge:
+        merged, section_defaults, section_loaded = to_merge.pop()
+        if section_loaded is None:
+            section_loaded = {}
+
+        # take loaded values, merging sections which have defaults
+        for k, v in section_loaded.items():
+            default = section_defaults.get(k)
+            if isinstance(default, dict):
+                merged[k] = {}
+                to_merge.append((merged[k], default, v))
             else:
-                result[k] = copy.deepcopy(v)
-        elif k in loaded_config:
-            result[k] = loaded_config[k]
-
-    # copy things with no defaults
-    for k, v in loaded_config.items():
-        if k not in result:
-            result[k] = v
+                merged[k] = v
+
+        # copy defaults which were not overridden
+        for k, v in section_defaults.items():
+            if k not in merged:
+                merged[k] = _copy_config_value(v)
 
     return result
 
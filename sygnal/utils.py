@@ -13,10 +13,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import json
-from logging import LoggerAdapter
-from typing import TYPE_CHECKING, Any, MutableMapping, Tuple
+from logging import Logger, LoggerAdapter
+from typing import TYPE_CHECKING, Any, Mapping, MutableMapping, Tuple
 
-from twisted.internet.defer import Deferred
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.interfaces import IConsumer
+from twisted.web.iweb import IBodyProducer
+from zope.interface import implementer
 
 if TYPE_CHECKING:
     from sygnal.sygnal import SygnalReactor
@@ -32,19 +35,54 @@ async def twisted_sleep(delay: float, twisted_reactor: "SygnalReactor") -> None:
         twisted_reactor: Reactor to use for sleeping.
 
     Returns:
-        a Deferred which fires in `delay` seconds.
+        a Deferred which fires in `delay` seconds. If `delay` is not positive,
+        returns immediately without going through the reactor.
     """
+    if delay <= 0:
+        return
+
     deferred: Deferred[None] = Deferred()
     twisted_reactor.callLater(delay, deferred.callback, None)
     await deferred
 
 
+@implementer(IBodyProducer)
+class BytesBodyProducer:
+    """
+    Produces a request body which is already entirely in memory.
+
+    Unlike FileBodyProducer, which reads the body in chunks in later reactor
+    iterations, this writes the whole body as soon as it is asked to.
+    """
+
+    def __init__(self, body: bytes):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer: IConsumer) -> "Deferred[None]":
+        consumer.write(self.body)
+        return succeed(None)
+
+    def pauseProducing(self) -> None:
+        pass
+
+    def resumeProducing(self) -> None:
+        pass
+
+    def stopProducing(self) -> None:
+        pass
+
+
 class NotificationLoggerAdapter(LoggerAdapter):
+    def __init__(self, logger: Logger, extra: Mapping[str, Any]) -> None:
+        super().__init__(logger, extra)
+        # the prefix is the same for every message, so only format it once
+        self._prefix = f"[{extra['request_id']}] "
+
     def process(
         self, msg: str, kwargs: MutableMapping[str, Any]
     ) -> Tuple[str, MutableMapping[str, Any]]:
-        assert self.extra
-        return f"[{self.extra['request_id']}] {msg}", kwargs
+        return self._prefix + msg, kwargs
 
 
 def _reject_invalid_json(val: Any) -> None:
@@ -54,3 +92,7 @@ def _reject_invalid_json(val: Any) -> None:
 
 # a custom JSON decoder which will reject Python extensions to JSON.
 json_decoder = json.JSONDecoder(parse_constant=_reject_invalid_json)
+
+# a JSON encoder which produces compact output, for the JSON bodies that we send,
+# which are only ever read by machines.
+json_encoder = json.JSONEncoder(separators=(",", ":"))
@@ -12,14 +12,14 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import json
 import logging
 import os.path
+import re
 from base64 import urlsafe_b64encode
 from hashlib import blake2s
-from io import BytesIO
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Pattern
-from urllib.parse import urlparse
+from operator import attrgetter
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Pattern, Tuple, cast
+from urllib.parse import urlsplit
 
 from matrix_common.regex import glob_to_regex
 from prometheus_client import Gauge, Histogram
@@ -27,7 +27,11 @@ from py_vapid import Vapid, VapidException
 from pywebpush import CaseInsensitiveDict, webpush
 from twisted.internet import defer
 from twisted.internet.defer import DeferredSemaphore
-from twisted.web.client import FileBodyProducer, HTTPConnectionPool, readBody
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.protocol import Protocol, connectionDone
+from twisted.python.failure import Failure
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IResponse
 
@@ -40,6 +44,7 @@ from sygnal.notifications import (
     Notification,
     NotificationContext,
 )
+from sygnal.utils import BytesBodyProducer, json_encoder
 
 if TYPE_CHECKING:
     from sygnal.sygnal import Sygnal
@@ -69,6 +74,42 @@ DEFAULT_TTL = 15 * 60  # in seconds
 # Max payload size is 4096
 MAX_BODY_LENGTH = 1000
 MAX_CIPHERTEXT_LENGTH = 2000
+# Response bodies are only logged, so don't read more than this of them
+MAX_RESPONSE_BODY_LENGTH = 8192
+# How long the VAPID tokens we sign are valid for, and how long before they expire
+# that we stop reusing them
+VAPID_TOKEN_LIFETIME = 12 * 60 * 60  # in seconds
+VAPID_TOKEN_RENEWAL_MARGIN = 60 * 60  # in seconds
+# The maximum number of push services to keep a signed VAPID token for
+MAX_CACHED_VAPID_TOKENS = 1024
+
+# The attributes of the notification which are included in the payload, if set
+PAYLOAD_ATTRS = (
+    "room_id",
+    "room_name",
+    "room_alias",
+    "membership",
+    "event_id",
+    "sender",
+    "sender_display_name",
+    "user_is_target",
+    "type",
+)
+_get_payload_attrs = attrgetter(*PAYLOAD_ATTRS)
+
+# The counts of the notification which are included in the payload, if set
+PAYLOAD_COUNTS = ("unread", "missed_calls")
+_get_payload_counts = attrgetter(*PAYLOAD_COUNTS)
+
+
+def _room_topic(room_id: str) -> bytes:
+    """
+    Get the topic to use for notifications about a room, so that the push
+    service can drop earlier notifications for the room.
+    """
+    # ask for a 22 byte hash, so the base64 of it is 32,
+    # the limit webpush allows for the topic
+    return urlsafe_b64encode(blake2s(room_id.encode(), digest_size=22).digest())
 
 
 class WebpushPushkin(ConcurrencyLimitedPushkin):
@@ -76,14 +117,14 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
     Pushkin that relays notifications to Google/Firebase Cloud Messaging.
     """
 
-    UNDERSTOOD_CONFIG_FIELDS = {
+    UNDERSTOOD_CONFIG_FIELDS = ConcurrencyLimitedPushkin.UNDERSTOOD_CONFIG_FIELDS | {
         "type",
         "max_connections",
         "vapid_private_key",
         "vapid_contact_email",
         "allowed_endpoints",
         "ttl",
-    } | ConcurrencyLimitedPushkin.UNDERSTOOD_CONFIG_FIELDS
+    }
 
     def __init__(self, name: str, sygnal: "Sygnal", config: Dict[str, Any]):
         super().__init__(name, sygnal, config)
@@ -95,12 +136,12 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
                 nonunderstood,
             )
 
-        self.http_pool = HTTPConnectionPool(reactor=sygnal.reactor)
         self.max_connections = self.get_config(
             "max_connections", int, DEFAULT_MAX_CONNECTIONS
         )
         self.connection_semaphore = DeferredSemaphore(self.max_connections)
-        self.http_pool.maxPersistentPerHost = self.max_connections
+        sygnal.reserve_http_pool_connections(self.max_connections)
+        self.http_pool = sygnal.http_pool
 
         tls_client_options_factory = ClientTLSOptionsFactory()
 
@@ -115,10 +156,17 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
         )
         self.http_request_factory = HttpRequestFactory()
 
-        self.allowed_endpoints: Optional[List[Pattern[str]]] = None
+        # a single regex matching any of the allowed endpoints, so that checking
+        # an endpoint is one match rather than one per allowed endpoint
+        self.allowed_endpoints: Optional[Pattern[str]] = None
         allowed_endpoints = self.get_config("allowed_endpoints", list)
         if allowed_endpoints:
-            self.allowed_endpoints = list(map(glob_to_regex, allowed_endpoints))
+            self.allowed_endpoints = re.compile(
+                "|".join(
+                    "(?:%s)" % glob_to_regex(glob).pattern for glob in allowed_endpoints
+                ),
+                re.IGNORECASE,
+            )
 
         privkey_filename = self.get_config("vapid_private_key", str)
         if not privkey_filename:
@@ -134,23 +182,26 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
             raise PushkinSetupException("'vapid_contact_email' not set in config")
         self.ttl = self.get_config("ttl", int, DEFAULT_TTL)
 
+        # signed VAPID headers, and when they expire, by push service origin
+        self._vapid_headers_cache: Dict[str, Tuple[int, Dict[str, str]]] = {}
+
     async def _dispatch_notification_unlimited(
         self, n: Notification, device: Device, context: NotificationContext
     ) -> List[str]:
         p256dh = device.pushkey
-        if not isinstance(device.data, dict):
-            logger.warn(
-                "Rejecting pushkey %s; device.data is not a dict", device.pushkey
-            )
+        # Device has already checked that the data is a dict, if present
+        device_data = device.data
+        if device_data is None:
+            logger.warn("Rejecting pushkey %s; device.data is missing", device.pushkey)
             return [device.pushkey]
 
         # drop notifications without an event id if requested,
         # see https://github.com/matrix-org/sygnal/issues/186
-        if device.data.get("events_only") is True and not n.event_id:
+        if device_data.get("events_only") is True and not n.event_id:
             return []
 
-        endpoint = device.data.get("endpoint")
-        auth = device.data.get("auth")
+        endpoint = device_data.get("endpoint")
+        auth = device_data.get("auth")
 
         if not p256dh or not isinstance(endpoint, str) or not isinstance(auth, str):
             logger.warn(
@@ -162,12 +213,10 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
             )
             return [device.pushkey]
 
-        endpoint_domain = urlparse(endpoint).netloc
+        endpoint_url = urlsplit(endpoint)
+        endpoint_domain = endpoint_url.netloc
         if self.allowed_endpoints:
-            allowed = any(
-                regex.fullmatch(endpoint_domain) for regex in self.allowed_endpoints
-            )
-            if not allowed:
+            if not self.allowed_endpoints.fullmatch(endpoint_domain):
                 logger.error(
                     "push gateway %s is not in allowed_endpoints, blocking request",
                     endpoint_domain,
@@ -179,24 +228,20 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
             "endpoint": endpoint,
             "keys": {"p256dh": p256dh, "auth": auth},
         }
-        payload = WebpushPushkin._build_payload(n, device)
-        data = json.dumps(payload)
+        notification_payload = WebpushPushkin._build_notification_payload(n)
+        payload = WebpushPushkin._build_payload(device, notification_payload)
+        data = json_encoder.encode(payload)
 
         # web push only supports normal and low priority, so assume normal if absent
         low_priority = n.prio == "low"
         # allow dropping earlier notifications in the same room if requested
         topic = None
-        if n.room_id and device.data.get("only_last_per_room") is True:
-            # ask for a 22 byte hash, so the base64 of it is 32,
-            # the limit webpush allows for the topic
-            topic = urlsafe_b64encode(
-                blake2s(n.room_id.encode(), digest_size=22).digest()
-            )
+        if n.room_id and device_data.get("only_last_per_room") is True:
+            topic = _room_topic(n.room_id)
 
-        # note that webpush modifies vapid_claims, so make sure it's only used once
-        vapid_claims = {
-            "sub": "mailto:{}".format(self.vapid_contact_email),
-        }
+        vapid_headers = self._get_vapid_headers(
+            f"{endpoint_url.scheme}://{endpoint_domain}"
+        )
         # we use the semaphore to actually limit the number of concurrent
         # requests, since the HTTPConnectionPool will actually just lead to more
         # requests being created but not pooled – it does not perform limiting.
@@ -210,14 +255,16 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
                         subscription_info=subscription_info,
                         data=data,
                         ttl=self.ttl,
-                        vapid_private_key=self.vapid_private_key,
-                        vapid_claims=vapid_claims,
+                        headers=vapid_headers,
                         requests_session=self.http_request_factory,
                     )
                     response = await request.execute(
                         self.http_agent, low_priority, topic
                     )
-                    response_text = (await readBody(response)).decode()
+                    response_body = await read_body_with_max_length(
+                        response, MAX_RESPONSE_BODY_LENGTH
+                    )
+                    response_text = response_body.decode(errors="replace")
         finally:
             self.connection_semaphore.release()
 
@@ -228,15 +275,57 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
             return [device.pushkey]
         return []
 
+    def _get_vapid_headers(self, audience: str) -> Dict[str, str]:
+        """
+        Get the VAPID headers to authenticate a request to a push service.
+
+        Signing a VAPID token is relatively expensive, and a token is valid for
+        every request to the same push service until it expires, so they are
+        reused until shortly before then rather than signed for every request.
+
+        Args:
+            audience: The origin of the push service.
+
+        Returns:
+            The VAPID headers.
+        """
+        now = int(self.sygnal.reactor.seconds())
+
+        cached = self._vapid_headers_cache.get(audience)
+        if cached is not None:
+            expiry, headers = cached
+            if now < expiry - VAPID_TOKEN_RENEWAL_MARGIN:
+                return headers
+            del self._vapid_headers_cache[audience]
+
+        expiry = now + VAPID_TOKEN_LIFETIME
+        headers = self.vapid_private_key.sign(
+            {
+                "sub": "mailto:{}".format(self.vapid_contact_email),
+                "aud": audience,
+                "exp": expiry,
+            }
+        )
+
+        if len(self._vapid_headers_cache) >= MAX_CACHED_VAPID_TOKENS:
+            # evict the least recently signed token
+            del self._vapid_headers_cache[next(iter(self._vapid_headers_cache))]
+        self._vapid_headers_cache[audience] = (expiry, headers)
+
+        return headers
+
     @staticmethod
-    def _build_payload(n: Notification, device: Device) -> Dict[str, Any]:
+    def _build_payload(
+        device: Device, notification_payload: Dict[str, Any]
+    ) -> Dict[str, Any]:
         """
         Build the payload data to be sent.
 
         Args:
-            n: Notification to build the payload for.
             device: Device information to which the constructed payload
             will be sent.
+            notification_payload: The result of _build_notification_payload
+            for the notification.
 
         Returns:
             JSON-compatible dict
@@ -248,27 +337,31 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
             if isinstance(default_payload, dict):
                 payload.update(default_payload)
 
-        for attr in [
-            "room_id",
-            "room_name",
-            "room_alias",
-            "membership",
-            "event_id",
-            "sender",
-            "sender_display_name",
-            "user_is_target",
-            "type",
-        ]:
-            value = getattr(n, attr, None)
+        payload.update(notification_payload)
+
+        return payload
+
+    @staticmethod
+    def _build_notification_payload(n: Notification) -> Dict[str, Any]:
+        """
+        Build the part of the payload data which only depends on the
+        notification, and not on the device it will be sent to.
+
+        Args:
+            n: Notification to build the payload for.
+
+        Returns:
+            JSON-compatible dict
+        """
+        payload = {}
+
+        for attr, value in zip(PAYLOAD_ATTRS, _get_payload_attrs(n)):
             if value:
                 payload[attr] = value
 
-        counts = getattr(n, "counts", None)
-        if counts is not None:
-            for attr in ["unread", "missed_calls"]:
-                count_value = getattr(counts, attr, None)
-                if count_value is not None:
-                    payload[attr] = count_value
+        for attr, count_value in zip(PAYLOAD_COUNTS, _get_payload_counts(n.counts)):
+            if count_value is not None:
+                payload[attr] = count_value
 
         if n.content and isinstance(n.content, dict):
             content = n.content.copy()
@@ -343,6 +436,65 @@ class WebpushPushkin(ConcurrencyLimitedPushkin):
         return False
 
 
+class _BoundedBodyReader(Protocol):
+    """
+    Protocol which reads a response body into memory, up to a maximum length.
+    Once that much has been read, the connection is dropped rather than reading
+    the rest of the body.
+
+    Args:
+        finished: a Deferred which will be callbacked with the body, truncated
+            to max_length, once it has been read
+        max_length: the maximum number of bytes of the body to read
+    """
+
+    def __init__(self, finished: "defer.Deferred[bytes]", max_length: int):
+        self.finished = finished
+        self.max_length = max_length
+        self.length = 0
+        self.chunks: List[bytes] = []
+
+    def dataReceived(self, data: bytes) -> None:
+        if self.length >= self.max_length:
+            # we've already stopped reading
+            return
+
+        self.chunks.append(data[: self.max_length - self.length])
+        self.length += len(data)
+        if self.length >= self.max_length:
+            cast(IPushProducer, self.transport).stopProducing()
+
+    def connectionLost(self, reason: Failure = connectionDone) -> None:
+        if self.finished.called:
+            return
+
+        if self.length >= self.max_length or reason.check(
+            ResponseDone, PotentialDataLoss
+        ):
+            self.finished.callback(b"".join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+
+def read_body_with_max_length(
+    response: IResponse, max_length: int
+) -> "defer.Deferred[bytes]":
+    """
+    Read the body of a response, like readBody, but only up to max_length
+    bytes of it.
+
+    Args:
+        response: The response to read the body of.
+        max_length: The maximum number of bytes of the body to read.
+
+    Returns:
+        a Deferred which fires with the body, truncated to max_length.
+    """
+    finished: "defer.Deferred[bytes]" = defer.Deferred()
+    response.deliverBody(_BoundedBodyReader(finished, max_length))
+    return finished
+
+
 class HttpRequestFactory:
     """
     Provide a post method that matches the API expected from pywebpush.
@@ -403,14 +555,15 @@ class HttpDelayedRequest:
     def execute(
         self, http_agent: ProxyAgent, low_priority: bool, topic: bytes
     ) -> "defer.Deferred[IResponse]":
-        body_producer = FileBodyProducer(BytesIO(self.data))
+        body_producer = BytesBodyProducer(self.data)
         # Convert the headers to the camelcase version.
+        # Constant values are given as bytes, so Headers needn't encode them.
         headers = {
-            b"User-Agent": ["sygnal"],
+            b"User-Agent": [b"sygnal"],
             b"Content-Encoding": [self.vapid_headers["content-encoding"]],
             b"Authorization": [self.vapid_headers["authorization"]],
             b"TTL": [self.vapid_headers["ttl"]],
-            b"Urgency": ["low" if low_priority else "normal"],
+            b"Urgency": [b"low" if low_priority else b"normal"],
         }
         if topic:
             headers[b"Topic"] = [topic]
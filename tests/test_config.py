@@ -0,0 +1,139 @@
+# Copyright 2025 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import logging.handlers
+import queue
+import unittest
+from typing import List
+
+from sygnal.sygnal import (
+    merge_left_with_defaults,
+    start_log_queue_listeners,
+    stop_log_queue_listeners,
+)
+
+DEFAULTS = {
+    "http": {"port": 5000, "bind_addresses": ["127.0.0.1"]},
+    "metrics": {"prometheus": {"enabled": False, "port": 8000}},
+    "proxy": None,
+    "apps": {},
+}
+
+
+class MergeLeftWithDefaultsTestCase(unittest.TestCase):
+    def test_no_loaded_config(self) -> None:
+        """
+        Test that the defaults are used when there is no loaded configuration.
+        """
+        self.assertEqual(merge_left_with_defaults(DEFAULTS, {}), DEFAULTS)
+        self.assertEqual(merge_left_with_defaults(DEFAULTS, None), DEFAULTS)  # type: ignore[arg-type]
+
+    def test_loaded_config_overrides_defaults(self) -> None:
+        """
+        Test that loaded values override defaults at any depth, that missing
+        values fall back to the defaults and that extra values are kept.
+        """
+        merged = merge_left_with_defaults(
+            DEFAULTS,
+            {
+                "http": {"port": 8008},
+                "metrics": {"prometheus": {"enabled": True}, "sentry": {}},
+                "metrics_unknown": 1,
+                "apps": {"com.example.app": {"type": "gcm"}},
+            },
+        )
+
+        self.assertEqual(
+            merged,
+            {
+                "http": {"port": 8008, "bind_addresses": ["127.0.0.1"]},
+                "metrics": {
+                    "prometheus": {"enabled": True, "port": 8000},
+                    "sentry": {},
+                },
+                "proxy": None,
+                "apps": {"com.example.app": {"type": "gcm"}},
+                "metrics_unknown": 1,
+            },
+        )
+
+    def test_empty_section_uses_defaults(self) -> None:
+        """
+        Test that a section left empty in the configuration file (and hence
+        loaded as None) falls back to the defaults.
+        """
+        merged = merge_left_with_defaults(DEFAULTS, {"metrics": None})
+        self.assertEqual(merged["metrics"], DEFAULTS["metrics"])
+
+    def test_defaults_are_not_modified(self) -> None:
+        """
+        Test that modifying a merged configuration does not modify the defaults.
+        """
+        merged = merge_left_with_defaults(DEFAULTS, {})
+        merged["metrics"]["prometheus"]["enabled"] = True
+        merged["apps"]["com.example.app"] = {"type": "gcm"}
+        merged["http"]["bind_addresses"].append("::1")
+
+        self.assertFalse(DEFAULTS["metrics"]["prometheus"]["enabled"])  # type: ignore[index]
+        self.assertEqual(DEFAULTS["apps"], {})
+        self.assertEqual(DEFAULTS["http"]["bind_addresses"], ["127.0.0.1"])  # type: ignore[index]
+
+
+class ListHandler(logging.Handler):
+    """A logging handler which keeps the messages of the records it handles."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.messages: List[str] = []
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.messages.append(record.getMessage())
+
+
+class LogQueueListenersTestCase(unittest.TestCase):
+    def test_listeners_are_started_and_stopped(self) -> None:
+        """
+        Test that the listener of a QueueHandler in the logging configuration is
+        started once, even if the handler is used by several loggers, and that
+        the queued records are handled by the time it has been stopped.
+        """
+        target = ListHandler()
+        log_queue: "queue.Queue[logging.LogRecord]" = queue.Queue()
+        handler = logging.handlers.QueueHandler(log_queue)
+        # this is what dictConfig does for a QueueHandler on Python 3.12+
+        handler.listener = logging.handlers.QueueListener(log_queue, target)  # type: ignore[attr-defined]
+
+        loggers = [
+            logging.getLogger("tests.queued"),
+            logging.getLogger("tests.queued2"),
+        ]
+        for log in loggers:
+            log.addHandler(handler)
+            log.propagate = False
+            self.addCleanup(log.removeHandler, handler)
+
+        listeners = start_log_queue_listeners()
+        self.assertEqual(listeners, [handler.listener])  # type: ignore[attr-defined]
+
+        loggers[0].warning("first")
+        loggers[1].warning("second")
+        stop_log_queue_listeners(listeners)
+
+        self.assertEqual(target.messages, ["first", "second"])
+
+    def test_no_listeners(self) -> None:
+        """
+        Test that nothing is started if there are no QueueHandlers.
+        """
+        self.assertEqual(start_log_queue_listeners(), [])
@@ -47,6 +47,13 @@ DEVICE_EXAMPLE_AMBIGIOUS = {
     "pushkey_ts": 42,
 }
 
+# App id not matching any pushkin, although it shares a prefix with some
+DEVICE_EXAMPLE_UNKNOWN = {
+    "app_id": "com.example",
+    "pushkey": "spqr",
+    "pushkey_ts": 42,
+}
+
 
 class HttpTestCase(testutils.TestCase):
     def setUp(self) -> None:
@@ -128,3 +135,19 @@ class HttpTestCase(testutils.TestCase):
         # must be rejected without calling the method
         self.assertEqual(0, method.call_count)
         self.assertEqual({"rejected": ["spqr"]}, resp)
+
+    def test_with_unknown_appid(self) -> None:
+        """
+        Tests the rejection case: An app id not matching any pushkin should be
+        rejected without processing.
+        """
+        # Arrange
+        method = self.apns_pushkin_snotif
+
+        # Act
+        resp = self._request(self._make_dummy_notification([DEVICE_EXAMPLE_UNKNOWN]))
+
+        # Assert
+        # must be rejected without calling the method
+        self.assertEqual(0, method.call_count)
+        self.assertEqual({"rejected": ["spqr"]}, resp)
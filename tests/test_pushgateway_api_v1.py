@@ -12,8 +12,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 
+from prometheus_client import REGISTRY
 from twisted.internet.address import IPv6Address
 from twisted.internet.testing import StringTransport
 
@@ -140,6 +141,15 @@ class PushGatewayApiV1TestCase(testutils.TestCase):
         """
         self.assertEqual(self._request({}), 400)
 
+    def test_invalid_counts_give_400(self) -> None:
+        """
+        Test that counts which are not a dict lead to a 400 Bad Request response.
+        """
+        for counts in ("abc", [1]):
+            notification = self._make_dummy_notification([DEVICE_ACCEPTED])
+            notification["notification"]["counts"] = counts
+            self.assertEqual(self._request(notification), 400)
+
     def test_exceptions_give_500(self) -> None:
         """
         Test that internal exceptions/errors lead to a 500 Internal Server Error
@@ -165,6 +175,60 @@ class PushGatewayApiV1TestCase(testutils.TestCase):
             500,
         )
 
+    def get_push_counts(self, pushkin_name: str) -> Dict[str, Optional[float]]:
+        """
+        Get the number of devices Sygnal has been asked to push to, and the
+        number of pushes it has sent through the given pushkin.
+        """
+        return {
+            "devices": REGISTRY.get_sample_value(
+                "sygnal_notifications_devices_received_total"
+            ),
+            "pushes": REGISTRY.get_sample_value(
+                "sygnal_per_pushkin_type_total", {"pushkin": pushkin_name}
+            ),
+        }
+
+    def test_push_counts(self) -> None:
+        """
+        Test that only the devices which have been reached are counted, even when
+        a device fails.
+        """
+        before = self.get_push_counts("com.example.spqr")
+
+        self.assertEqual(
+            self._request(
+                self._make_dummy_notification([DEVICE_RAISE_EXCEPTION, DEVICE_ACCEPTED])
+            ),
+            500,
+        )
+
+        after = self.get_push_counts("com.example.spqr")
+        self.assertEqual(after["devices"], (before["devices"] or 0) + 1)
+        self.assertEqual(after["pushes"], (before["pushes"] or 0) + 1)
+
+    def test_push_counts_for_new_pushkin(self) -> None:
+        """
+        Test that pushes through a pushkin added after the API was set up are
+        still counted, and don't stop the request from being finished.
+        """
+        self.sygnal.pushkins["com.example.new"] = TestPushkin(
+            "com.example.new", self.sygnal, {}
+        )
+        before = self.get_push_counts("com.example.new")
+
+        self.assertEqual(
+            self._request(
+                self._make_dummy_notification(
+                    [dict(DEVICE_ACCEPTED, app_id="com.example.new")]
+                )
+            ),
+            {"rejected": []},
+        )
+
+        after = self.get_push_counts("com.example.new")
+        self.assertEqual(after["pushes"], (before["pushes"] or 0) + 1)
+
     def test_remote_errors_give_502(self) -> None:
         """
         Test that errors caused by remote services such as GCM or APNS
@@ -235,3 +299,22 @@ class PushGatewayApiV1TestCase(testutils.TestCase):
         # default max upload size is 512K, so it should drop on the next buffer after
         # that.
         self.assertEqual(sent, 513 * 1024)
+
+    def test_overlong_requests_with_content_length_are_rejected(self) -> None:
+        """
+        Test that a request which declares a body larger than the maximum size
+        is dropped before any of the body is received.
+        """
+        transport = StringTransport()
+        protocol = self.site.buildProtocol(IPv6Address("TCP", "::1", 2345))
+        assert protocol is not None
+        protocol.makeConnection(transport)
+
+        protocol.dataReceived(
+            b"POST / HTTP/1.1\r\n"
+            b"Connection: close\r\n"
+            b"Content-Length: 1048576\r\n"
+            b"\r\n"
+        )
+
+        self.assertTrue(transport.disconnected)
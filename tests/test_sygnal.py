@@ -0,0 +1,113 @@
+# Copyright 2025 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import tempfile
+from typing import Any, Dict, List, Union
+
+from py_vapid import Vapid
+from twisted.internet.defer import ensureDeferred
+from twisted.trial import unittest
+
+from sygnal.exceptions import PushkinSetupException
+from sygnal.gcmpushkin import GcmPushkin
+from sygnal.notifications import Device, Notification, NotificationContext, Pushkin
+from sygnal.sygnal import CONFIG_DEFAULTS, Sygnal, merge_left_with_defaults
+from sygnal.webpushpushkin import WebpushPushkin
+
+from tests import testutils
+from tests.testutils import ExtendedMemoryReactorClock
+
+
+class FailingPushkin(Pushkin):
+    """A pushkin which fails to be created."""
+
+    def __init__(self, name: str, sygnal: "Sygnal", config: Dict[str, Any]):
+        raise PushkinSetupException(f"{name} is broken")
+
+    async def dispatch_notification(
+        self, n: Notification, device: Device, context: NotificationContext
+    ) -> List[str]:
+        return []
+
+
+class PushkinStartupTestCase(unittest.TestCase):
+    def test_every_failure_is_logged(self) -> None:
+        """
+        Test that when several pushkins fail to be created, each failure is
+        logged with its traceback, and startup fails.
+        """
+        config = merge_left_with_defaults(
+            CONFIG_DEFAULTS,
+            {
+                "apps": {
+                    "com.example.one": {"type": "tests.test_sygnal.FailingPushkin"},
+                    "com.example.two": {"type": "tests.test_sygnal.FailingPushkin"},
+                }
+            },
+        )
+        sygnal = Sygnal(config, ExtendedMemoryReactorClock())  # type: ignore[arg-type]
+
+        with self.assertLogs("sygnal.sygnal", "ERROR") as logs:
+            failure = self.failureResultOf(
+                ensureDeferred(sygnal.make_pushkins_then_start())
+            )
+
+        failure.trap(PushkinSetupException)
+        self.assertEqual(len(logs.records), 2)
+        for record, app_id in zip(logs.records, ["com.example.one", "com.example.two"]):
+            self.assertIn(app_id, record.getMessage())
+            assert record.exc_info is not None
+            self.assertEqual(str(record.exc_info[1]), f"{app_id} is broken")
+            self.assertIsNotNone(record.exc_info[2])
+
+
+class SharedHttpPoolTestCase(testutils.TestCase):
+    def config_setup(self, config: Dict[str, Any]) -> None:
+        self.vapid_key_file = tempfile.NamedTemporaryFile()
+        vapid_key = Vapid()
+        vapid_key.generate_keys()
+        vapid_key.save_key(self.vapid_key_file.name)
+
+        config["apps"]["com.example.gcm"] = {"type": "gcm", "api_key": "kii"}
+        config["apps"]["com.example.gcm.other"] = {
+            "type": "gcm",
+            "api_key": "kii",
+            "max_connections": 3,
+        }
+        config["apps"]["com.example.webpush"] = {
+            "type": "webpush",
+            "vapid_private_key": self.vapid_key_file.name,
+            "vapid_contact_email": "sygnal@example.com",
+            "max_connections": 5,
+        }
+
+    def tearDown(self) -> None:
+        self.vapid_key_file.close()
+
+    def test_connection_pool_is_shared(self) -> None:
+        """
+        Tests that the pushkins share Sygnal's connection pool, and that it keeps
+        enough connections open per host for all of them.
+        """
+        pushkins: List[Union[GcmPushkin, WebpushPushkin]] = []
+        for pushkin in self.sygnal.pushkins.values():
+            assert isinstance(pushkin, (GcmPushkin, WebpushPushkin))
+            pushkins.append(pushkin)
+        self.assertEqual(len(pushkins), 3)
+
+        for pushkin in pushkins:
+            self.assertIs(pushkin.http_pool, self.sygnal.http_pool)
+        self.assertEqual(
+            self.sygnal.http_pool.maxPersistentPerHost,
+            sum(pushkin.max_connections for pushkin in pushkins),
+        )
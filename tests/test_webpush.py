@@ -0,0 +1,397 @@
+# Copyright 2025 The Matrix.org Foundation C.I.C.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import tempfile
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from typing import Any, Dict, List, Optional, Tuple
+from unittest.mock import patch
+
+import http_ece
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from py_vapid import Vapid
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.error import ConnectionLost
+from twisted.internet.testing import StringTransport
+from twisted.python.failure import Failure
+from twisted.trial import unittest
+from twisted.web.client import ResponseDone
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer, IResponse
+
+from sygnal.utils import BytesBodyProducer
+from sygnal.webpushpushkin import (
+    MAX_RESPONSE_BODY_LENGTH,
+    VAPID_TOKEN_LIFETIME,
+    VAPID_TOKEN_RENEWAL_MARGIN,
+    WebpushPushkin,
+    read_body_with_max_length,
+)
+
+from tests import testutils
+
+
+def get_vapid_token(headers: Dict[str, str]) -> str:
+    """
+    Get the VAPID token (a JWT) from the given headers.
+    """
+    # the header is of the form "vapid t=<token>,k=<public key>"
+    return headers["Authorization"].split("t=", 1)[1].split(",", 1)[0]
+
+
+def urlsafe_b64decode_unpadded(data: str) -> bytes:
+    return urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def get_vapid_claims(headers: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Get the claims of the VAPID token in the given headers.
+    """
+    return json.loads(
+        urlsafe_b64decode_unpadded(get_vapid_token(headers).split(".")[1])
+    )
+
+
+class Subscription:
+    """
+    The keys of a push subscription, which can decrypt what is pushed to it.
+    """
+
+    def __init__(self) -> None:
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.auth_secret = os.urandom(16)
+
+    def get_device(self, endpoint: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Get a device for the subscription, as given in a notification request.
+        """
+        public_key = self.private_key.public_key().public_bytes(
+            serialization.Encoding.X962, serialization.PublicFormat.UncompressedPoint
+        )
+        return {
+            "app_id": "com.example.webpush",
+            "pushkey": urlsafe_b64encode(public_key).decode().rstrip("="),
+            "data": {
+                "endpoint": endpoint,
+                "auth": urlsafe_b64encode(self.auth_secret).decode().rstrip("="),
+                **data,
+            },
+        }
+
+    def decrypt(self, body: bytes) -> Dict[str, Any]:
+        return json.loads(
+            http_ece.decrypt(
+                body, private_key=self.private_key, auth_secret=self.auth_secret
+            )
+        )
+
+
+class FakeResponse:
+    """A response to a request made by FakeAgent, with an empty body."""
+
+    code = 201
+    phrase = b"Created"
+    headers = Headers()
+
+    def deliverBody(self, protocol: Any) -> None:
+        protocol.makeConnection(StringTransport())
+        protocol.connectionLost(Failure(ResponseDone()))
+
+
+class FakeAgent:
+    """An HTTP agent which records the requests made with it."""
+
+    def __init__(self) -> None:
+        self.requests: List[Tuple[bytes, Headers, bytes]] = []
+
+    def request(
+        self,
+        method: bytes,
+        uri: bytes,
+        headers: Headers,
+        bodyProducer: Optional[IBodyProducer] = None,
+    ) -> "Deferred[IResponse]":
+        assert isinstance(bodyProducer, BytesBodyProducer)
+        self.requests.append((uri, headers, bodyProducer.body))
+        return succeed(FakeResponse())  # type: ignore[arg-type]
+
+
+class WebpushTestCase(testutils.TestCase):
+    def config_setup(self, config: Dict[str, Any]) -> None:
+        self.vapid_key_file = tempfile.NamedTemporaryFile()
+        vapid_key = Vapid()
+        vapid_key.generate_keys()
+        vapid_key.save_key(self.vapid_key_file.name)
+        config["apps"]["com.example.webpush"] = {
+            "type": "webpush",
+            "vapid_private_key": self.vapid_key_file.name,
+            "vapid_contact_email": "sygnal@example.com",
+            "allowed_endpoints": [
+                "push.example.com",
+                "*.push.example.org",
+                "updates.?.example.net",
+            ],
+        }
+
+    def tearDown(self) -> None:
+        self.vapid_key_file.close()
+
+    def get_pushkin(self) -> WebpushPushkin:
+        pushkin = self.sygnal.pushkins["com.example.webpush"]
+        assert isinstance(pushkin, WebpushPushkin)
+        return pushkin
+
+    def test_default_payload_is_merged_per_device(self) -> None:
+        """
+        Tests that each device gets the payload built from the notification,
+        with that device's default_payload merged in.
+        """
+        pushkin = self.get_pushkin()
+        agent = FakeAgent()
+        pushkin.http_agent = agent  # type: ignore[assignment]
+
+        subscriptions = [Subscription(), Subscription()]
+        devices = [
+            subscriptions[0].get_device(
+                "https://push.example.com/1", {"default_payload": {"badge": 1}}
+            ),
+            subscriptions[1].get_device("https://push.example.com/2", {}),
+        ]
+
+        response = self._request(self._make_dummy_notification(devices))
+
+        self.assertEqual(response, {"rejected": []})
+
+        self.assertEqual(
+            [uri for uri, _headers, _body in agent.requests],
+            [b"https://push.example.com/1", b"https://push.example.com/2"],
+        )
+        payloads = [
+            subscription.decrypt(body)
+            for subscription, (_uri, _headers, body) in zip(
+                subscriptions, agent.requests
+            )
+        ]
+        notification_payload = {
+            "room_id": "!slw48wfj34rtnrf:example.com",
+            "room_name": "Mission Control",
+            "room_alias": "#exampleroom:matrix.org",
+            "event_id": "$qTOWWTEL48yPm3uT-gdNhFcoHxfKbZuqRVnnWWSkGBs",
+            "sender": "@exampleuser:matrix.org",
+            "sender_display_name": "Major Tom",
+            "type": "m.room.message",
+            "unread": 2,
+            "missed_calls": 1,
+            "content": {
+                "msgtype": "m.text",
+                "body": "I'm floating in a most peculiar way.",
+                "other": 1,
+            },
+        }
+        self.assertEqual(payloads[0], {"badge": 1, **notification_payload})
+        self.assertEqual(payloads[1], notification_payload)
+
+    def test_allowed_endpoints(self) -> None:
+        """
+        Tests that an endpoint is allowed if its domain matches any of the
+        allowed_endpoints globs in full, ignoring case.
+        """
+        allowed_endpoints = self.get_pushkin().allowed_endpoints
+        assert allowed_endpoints is not None
+
+        for domain in [
+            "push.example.com",
+            "PUSH.Example.COM",
+            "a.push.example.org",
+            "a.b.push.example.org",
+            "updates.1.example.net",
+        ]:
+            self.assertIsNotNone(allowed_endpoints.fullmatch(domain), domain)
+
+        for domain in [
+            # each glob must match the whole domain
+            "push.example.com.evil.com",
+            "evilpush.example.com",
+            "push.example.org",
+            "a.push.example.org.evil.com",
+            "updates.12.example.net",
+            "push.example.comupdates.1.example.net",
+            "other.example.com",
+        ]:
+            self.assertIsNone(allowed_endpoints.fullmatch(domain), domain)
+
+    def test_disallowed_endpoint(self) -> None:
+        """
+        Tests that nothing is sent to an endpoint which isn't allowed, and that
+        its pushkey isn't rejected.
+        """
+        pushkin = self.get_pushkin()
+        agent = FakeAgent()
+        pushkin.http_agent = agent  # type: ignore[assignment]
+
+        device = Subscription().get_device("https://push.example.com.evil.com/1", {})
+        response = self._request(self._make_dummy_notification([device]))
+
+        self.assertEqual(response, {"rejected": []})
+        self.assertEqual(agent.requests, [])
+
+    def test_vapid_claims(self) -> None:
+        """
+        Tests that the VAPID token is for the push service, is signed by our key
+        and expires after the token lifetime.
+        """
+        pushkin = self.get_pushkin()
+        self.reactor.advance(1000)
+
+        headers = pushkin._get_vapid_headers("https://push.example.com")
+
+        self.assertEqual(
+            get_vapid_claims(headers),
+            {
+                "aud": "https://push.example.com",
+                "exp": int(self.reactor.seconds()) + VAPID_TOKEN_LIFETIME,
+                "sub": "mailto:sygnal@example.com",
+            },
+        )
+        # the JWT is signed with ES256, whose signature is r and s concatenated
+        signing_input, signature = get_vapid_token(headers).rsplit(".", 1)
+        raw_signature = urlsafe_b64decode_unpadded(signature)
+        pushkin.vapid_private_key.public_key.verify(
+            encode_dss_signature(
+                int.from_bytes(raw_signature[:32], "big"),
+                int.from_bytes(raw_signature[32:], "big"),
+            ),
+            signing_input.encode(),
+            ec.ECDSA(hashes.SHA256()),
+        )
+
+    def test_vapid_headers_are_reused(self) -> None:
+        """
+        Tests that the VAPID headers for a push service are reused until shortly
+        before they expire, and are then signed again.
+        """
+        pushkin = self.get_pushkin()
+
+        headers = pushkin._get_vapid_headers("https://push.example.com")
+        self.assertIs(pushkin._get_vapid_headers("https://push.example.com"), headers)
+
+        # other push services get their own token
+        other_headers = pushkin._get_vapid_headers("https://push.example.org")
+        self.assertEqual(
+            get_vapid_claims(other_headers)["aud"], "https://push.example.org"
+        )
+
+        # just before the renewal margin, the headers are still reused
+        self.reactor.advance(VAPID_TOKEN_LIFETIME - VAPID_TOKEN_RENEWAL_MARGIN - 1)
+        self.assertIs(pushkin._get_vapid_headers("https://push.example.com"), headers)
+
+        # but not once it has been reached
+        self.reactor.advance(1)
+        renewed_headers = pushkin._get_vapid_headers("https://push.example.com")
+        self.assertNotEqual(renewed_headers, headers)
+        self.assertEqual(
+            get_vapid_claims(renewed_headers)["exp"],
+            int(self.reactor.seconds()) + VAPID_TOKEN_LIFETIME,
+        )
+
+    def test_vapid_headers_cache_is_bounded(self) -> None:
+        """
+        Tests that only a limited number of VAPID headers are kept, dropping the
+        oldest first.
+        """
+        pushkin = self.get_pushkin()
+
+        with patch("sygnal.webpushpushkin.MAX_CACHED_VAPID_TOKENS", 2):
+            first = pushkin._get_vapid_headers("https://one.example.com")
+            pushkin._get_vapid_headers("https://two.example.com")
+            pushkin._get_vapid_headers("https://three.example.com")
+
+            self.assertEqual(
+                list(pushkin._vapid_headers_cache),
+                ["https://two.example.com", "https://three.example.com"],
+            )
+            # the dropped push service gets a new token
+            self.assertIsNot(
+                pushkin._get_vapid_headers("https://one.example.com"), first
+            )
+
+
+class BodyResponse:
+    """A response whose body is delivered by the test."""
+
+    def __init__(self) -> None:
+        self.transport = StringTransport()
+        self.protocol: Any = None
+
+    def deliverBody(self, protocol: Any) -> None:
+        self.protocol = protocol
+        protocol.makeConnection(self.transport)
+
+
+class ReadBodyWithMaxLengthTestCase(unittest.TestCase):
+    def read_body(self, chunks: List[bytes], reason: Exception) -> "Deferred[bytes]":
+        """
+        Read a response body made of the given chunks, after which the
+        connection is lost for the given reason.
+        """
+        response = BodyResponse()
+        self.transport = response.transport
+        body = read_body_with_max_length(
+            response, MAX_RESPONSE_BODY_LENGTH  # type: ignore[arg-type]
+        )
+        for chunk in chunks:
+            response.protocol.dataReceived(chunk)
+        response.protocol.connectionLost(Failure(reason))
+        return body
+
+    def test_short_body(self) -> None:
+        """
+        Tests that a body under the limit is read in full.
+        """
+        body = self.read_body([b"abc", b"def"], ResponseDone())
+        self.assertEqual(self.successResultOf(body), b"abcdef")
+        self.assertEqual(self.transport.producerState, "producing")
+
+    def test_long_body_is_truncated(self) -> None:
+        """
+        Tests that only the start of a body over the limit is read, and that the
+        rest of it isn't downloaded.
+        """
+        chunks = [b"a" * 5000, b"b" * 5000, b"c" * 5000]
+        # stopping the transport loses the connection, with an error
+        body = self.read_body(chunks, ConnectionLost())
+
+        self.assertEqual(
+            self.successResultOf(body),
+            (b"a" * 5000 + b"b" * 5000)[:MAX_RESPONSE_BODY_LENGTH],
+        )
+        self.assertEqual(self.transport.producerState, "stopped")
+
+    def test_potential_data_loss(self) -> None:
+        """
+        Tests that a body without a length is read up to the end of the
+        connection.
+        """
+        body = self.read_body([b"abc"], PotentialDataLoss())
+        self.assertEqual(self.successResultOf(body), b"abc")
+
+    def test_connection_lost(self) -> None:
+        """
+        Tests that losing the connection before the body is complete fails.
+        """
+        body = self.read_body([b"abc"], ConnectionLost())
+        self.failureResultOf(body, ConnectionLost)